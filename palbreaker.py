@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+"""
+Circuit breakers for PAL provider endpoints.
+
+One breaker is kept per (base URL, model). After consecutive failures it opens and
+requests fail fast until a probe succeeds, which moves it to half-open. The next real
+request then either closes the breaker or opens it again.
+"""
+import os
+import time
+
+failure_threshold = int(os.getenv('BREAKER_FAILURES', '3'))
+probe_interval = float(os.getenv('BREAKER_PROBE_INTERVAL', '30'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+breakers = {}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, base_url, model):
+        super().__init__(f'Circuit open for {model} at {base_url}')
+        self.base_url = base_url
+        self.model = model
+
+
+def get_breaker(base_url, model):
+    key = (base_url, model)
+    if key not in breakers:
+        breakers[key] = {
+            'state': CLOSED,
+            'failures': 0,
+            'opened_at': 0.0,
+            'last_error': '',
+            'trial_in_flight': False,
+        }
+    return breakers[key]
+
+
+def allow_request(base_url, model):
+    """
+    Return True if a request may be sent to this endpoint now.
+    Half-open breakers let a single trial request through.
+    """
+    breaker = get_breaker(base_url, model)
+    if breaker['state'] == CLOSED:
+        return True
+    if breaker['state'] == HALF_OPEN and not breaker['trial_in_flight']:
+        breaker['trial_in_flight'] = True
+        return True
+    return False
+
+
+def record_success(base_url, model):
+    breaker = get_breaker(base_url, model)
+    if breaker['state'] != CLOSED:
+        print(f'Circuit closed for {model} at {base_url}', flush=True)
+    breaker.update({'state': CLOSED, 'failures': 0, 'trial_in_flight': False})
+
+
+def record_failure(base_url, model, err):
+    """
+    Count a failure. Returns True if this failure opened the breaker.
+    """
+    breaker = get_breaker(base_url, model)
+    breaker['failures'] += 1
+    breaker['last_error'] = str(err)
+    breaker['trial_in_flight'] = False
+    if breaker['state'] == OPEN:
+        return False
+    if breaker['state'] == HALF_OPEN or breaker['failures'] >= failure_threshold:
+        breaker.update({'state': OPEN, 'opened_at': time.time()})
+        print(f'Circuit opened for {model} at {base_url} after {breaker["failures"]} failures: {err}', flush=True)
+        return True
+    return False
+
+
+def record_probe_success(base_url, model):
+    breaker = get_breaker(base_url, model)
+    if breaker['state'] == OPEN:
+        print(f'Circuit half-open for {model} at {base_url}', flush=True)
+        breaker.update({'state': HALF_OPEN, 'trial_in_flight': False})
+
+
+def breaker_states():
+    """
+    Return a snapshot of every breaker for monitoring.
+    """
+    return {
+        f'{model}@{base_url}': {
+            'state': breaker['state'],
+            'failures': breaker['failures'],
+            'open_for': round(time.time() - breaker['opened_at'], 1) if breaker['state'] != CLOSED else 0,
+            'last_error': breaker['last_error'],
+        }
+        for (base_url, model), breaker in breakers.items()
+    }
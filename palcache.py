@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+Shared local cache for PAL.
+
+Entries and counters live in a SQLite file so every shard process on the host
+sees the same judgement, answer and audio caches and the same usage counters.
+"""
+import json
+import os
+import sqlite3
+import time
+
+cache_path = os.getenv('PAL_CACHE_PATH', '/tmp/palcache.sqlite3')
+
+_connection = None
+
+
+def get_connection():
+    """
+    Open the cache database on first use and create the tables if needed.
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(cache_path, timeout=5, isolation_level=None, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.execute('PRAGMA synchronous=NORMAL')
+        _connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, '
+            'PRIMARY KEY (namespace, key))'
+        )
+        _connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    return _connection
+
+
+def cache_get(namespace, key):
+    """
+    Return the cached value for key, or None if it is missing or expired.
+    """
+    try:
+        row = get_connection().execute(
+            'SELECT value, expires FROM cache WHERE namespace = ? AND key = ?', (namespace, key)
+        ).fetchone()
+    except sqlite3.Error as err:
+        print(f'Cache read error ({namespace}): {err}', flush=True)
+        return None
+
+    if not row or row[1] < time.time():
+        return None
+    return json.loads(row[0])
+
+
+def cache_set(namespace, key, value, ttl, max_entries=None):
+    """
+    Store a JSON-serialisable value for ttl seconds.
+    With max_entries, the entries closest to expiry are evicted to keep the namespace within that size.
+    """
+    try:
+        connection = get_connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), time.time() + ttl),
+        )
+        if max_entries:
+            connection.execute(
+                'DELETE FROM cache WHERE namespace = ? AND key NOT IN '
+                '(SELECT key FROM cache WHERE namespace = ? ORDER BY expires DESC LIMIT ?)',
+                (namespace, namespace, max_entries),
+            )
+    except sqlite3.Error as err:
+        print(f'Cache write error ({namespace}): {err}', flush=True)
+
+
+def cache_purge():
+    """
+    Drop expired entries from every namespace.
+    """
+    try:
+        get_connection().execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+    except sqlite3.Error as err:
+        print(f'Cache purge error: {err}', flush=True)
+
+
+def counter_incr(name, amount=1):
+    """
+    Add amount to a shared usage counter.
+    """
+    if not amount:
+        return
+    try:
+        get_connection().execute(
+            'INSERT INTO counters (name, value) VALUES (?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+            (name, int(amount)),
+        )
+    except sqlite3.Error as err:
+        print(f'Counter update error ({name}): {err}', flush=True)
+
+
+def counter_values():
+    """
+    Return every shared usage counter as a dictionary.
+    """
+    try:
+        return dict(get_connection().execute('SELECT name, value FROM counters').fetchall())
+    except sqlite3.Error as err:
+        print(f'Counter read error: {err}', flush=True)
+        return {}
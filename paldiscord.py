@@ -4,19 +4,29 @@ Available models
   Akash: https://chatapi.akash.network/documentation
   Perplexity: https://docs.perplexity.ai/guides/model-cards
 """
+import argparse
 import asyncio
+import contextlib
+import contextvars
 import hashlib
+import io
+import json
 import os
 import re
+import shutil
+import signal
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 
-import yt_dlp
 import discord
-from openai import AsyncOpenAI
-from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam
-from typing import cast
+import palbreaker
+import palcache
+import palindex
 import palpersonalities
+import paltrace
 
 # Load environment variables
 discord_token = os.getenv('DISCORD_TOKEN', 'not_set')
@@ -27,20 +37,76 @@ openai_model = os.getenv('OPENAI_MODEL', 'not_set')
 akash_api_key = os.getenv('AKASH_API_KEY', 'not_set')
 akash_base_url = os.getenv('AKASH_BASE_URL', 'not_set')
 akash_model = os.getenv('AKASH_MODEL', 'not_set')
-
-# Set up Discord client
-intents = discord.Intents.default()
-intents.message_content = True
-intents.guilds = True
-intents.guild_messages = True
-discord_client = discord.Client(intents=intents)
-print(f'DEBUG discord_client: {discord_client}', flush=True)
-
-# Set up OpenAI client
-openai_client = AsyncOpenAI(api_key=openai_api_key, base_url=openai_base_url)
-akash_client = AsyncOpenAI(api_key=akash_api_key, base_url=akash_base_url)
-print(f'DEBUG openai_client: {openai_client}', flush=True)
-print(f'DEBUG akash_client: {akash_client}', flush=True)
+# Sharding (SHARD_COUNT=0 runs a single unsharded client)
+shard_count = int(os.getenv('SHARD_COUNT', '0'))
+shard_ids = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()]
+process_count = max(1, int(os.getenv('PROCESS_COUNT', '1')))
+# Rolling channel summaries
+summary_base_url = os.getenv('SUMMARY_BASE_URL') or akash_base_url
+summary_api_key = os.getenv('SUMMARY_API_KEY', '')
+summary_model = os.getenv('SUMMARY_MODEL', 'Meta-Llama-3-3-70B-Instruct')
+summary_threshold = int(os.getenv('SUMMARY_THRESHOLD', '30'))
+summary_tail = int(os.getenv('SUMMARY_TAIL', '10'))
+summary_retry_max = 600  # seconds between attempts while the summary model keeps failing
+summary_fold_max = 100  # messages folded into the summary per call
+summary_buffer_max = 500  # unsummarized messages kept per channel; older ones remain searchable in the index
+# Provider timeouts and circuit breaker fallback
+provider_timeout = float(os.getenv('PROVIDER_TIMEOUT', '60'))
+fallback_base_url = os.getenv('FALLBACK_BASE_URL', '')
+fallback_model = os.getenv('FALLBACK_MODEL', '')
+fallback_api_key = os.getenv('FALLBACK_API_KEY', '')
+# Online answer cache
+online_cache_ttl = int(os.getenv('ONLINE_CACHE_TTL', '300'))
+online_cache_size = int(os.getenv('ONLINE_CACHE_SIZE', '500'))
+# Audio scratch space (point AUDIO_SCRATCH_DIR at a tmpfs such as /dev/shm to keep jobs off disk)
+audio_scratch_root = os.getenv('AUDIO_SCRATCH_DIR', tempfile.gettempdir())
+audio_scratch_prefix = 'pal-audio-'
+audio_in_memory = os.getenv('AUDIO_IN_MEMORY', 'false').lower() in ('1', 'true', 'yes')
+audio_concurrency = max(1, int(os.getenv('AUDIO_CONCURRENCY', '2')))
+audio_max_items = max(1, int(os.getenv('AUDIO_MAX_ITEMS', '10')))
+# Uploaded audio is reused for repeat requests of the same video (shared between shard processes)
+audio_cache_ttl = int(os.getenv('AUDIO_CACHE_TTL', '86400'))
+audio_cache_size = int(os.getenv('AUDIO_CACHE_SIZE', '1000'))
+# Speculative prefetch on typing (comma separated channel names, empty disables it)
+prefetch_channels = [name.strip() for name in os.getenv('PREFETCH_CHANNELS', '').split(',') if name.strip()]
+prefetch_ttl = float(os.getenv('PREFETCH_TTL', '30'))
+# Relevant earlier messages retrieved from the local index
+index_top_k = int(os.getenv('INDEX_TOP_K', '5'))
+# Batched judge calls: judges sharing an endpoint and model are asked in one completion
+judge_batching = os.getenv('JUDGE_BATCHING', 'false').lower() in ('1', 'true', 'yes')
+# Optionally move every judge on an endpoint onto one model so they can share a batch
+judge_batch_model = os.getenv('JUDGE_BATCH_MODEL', '')
+
+# API key for each provider base URL; other endpoints reuse these unless given their own key
+api_keys = {openai_base_url: openai_api_key, akash_base_url: akash_api_key}
+if summary_api_key:
+    api_keys.setdefault(summary_base_url, summary_api_key)
+if fallback_api_key:
+    api_keys.setdefault(fallback_base_url, fallback_api_key)
+if fallback_base_url and fallback_base_url not in api_keys:
+    print(f'FALLBACK_BASE_URL {fallback_base_url} has no API key (set FALLBACK_API_KEY), fallback disabled', flush=True)
+    fallback_base_url = ''
+if summary_base_url not in api_keys:
+    print(f'SUMMARY_BASE_URL {summary_base_url} has no API key (set SUMMARY_API_KEY), summaries will fail', flush=True)
+
+# Clients are constructed on first use (see build_discord_client and get_ai_client)
+discord_client = None
+ai_clients = {}
+# Callers can set a {'calls': 0} dict to count the provider requests made on their behalf (see paljudge)
+provider_call_counter = contextvars.ContextVar('provider_call_counter', default=None)
+# References to fire-and-forget tasks so they are not garbage collected
+background_tasks = set()
+# Handler tasks keyed by the ID of the message that triggered them
+inflight_tasks = {}
+# Monotonic time until which each channel's prefetch is still considered warm
+prefetch_expiry = {}
+# Discord history fetched on typing in untracked channels, used by a +history request before the prefetch expires
+prefetched_history = {}
+
+# Modules reported by --check-startup
+startup_modules = [
+    'discord', 'openai', 'yt_dlp', 'palbreaker', 'palcache', 'palindex', 'palpersonalities', 'paltrace', 'paldiscord',
+]
 
 # Channel settings
 channel_settings = {
@@ -68,6 +134,8 @@ channel_settings = {
         'openai_base_url': openai_base_url,
         'openai_model': 'sonar-pro',
         'system_prompt': 'online',
+        # Set to False to always fetch fresh online answers in this channel
+        'online_cache': True,
     },
     'pal-offline': {
         'openai_base_url': openai_base_url,
@@ -89,14 +157,129 @@ system_prompt_dict = {
 }
 
 
+def get_ai_client(base_url):
+    """
+    Return the OpenAI-compatible client for base_url, importing openai and constructing the client on first use.
+    """
+    if base_url not in ai_clients:
+        if base_url not in api_keys:
+            raise ValueError(f'No API key configured for {base_url}')
+        from openai import AsyncOpenAI
+
+        ai_clients[base_url] = AsyncOpenAI(api_key=api_keys[base_url], base_url=base_url, http_client=build_http_client())
+        print(f'DEBUG ai_client: {ai_clients[base_url]}', flush=True)
+    return ai_clients[base_url]
+
+
+def build_http_client():
+    """
+    With prefetch enabled, keep idle provider connections open for the prefetch TTL instead of the 5 second default.
+    Returns None to use the openai default client otherwise.
+    """
+    if not prefetch_channels:
+        return None
+    from openai import DEFAULT_CONNECTION_LIMITS, DefaultAsyncHttpxClient
+
+    # Build the limits with the same class openai uses for its defaults
+    limits = type(DEFAULT_CONNECTION_LIMITS)(
+        max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+        max_keepalive_connections=DEFAULT_CONNECTION_LIMITS.max_keepalive_connections,
+        keepalive_expiry=prefetch_ttl,
+    )
+    return DefaultAsyncHttpxClient(limits=limits)
+
+
+async def create_completion(base_url, model, messages, max_tokens, temperature, fallback=None):
+    """
+    Send a chat completion through the circuit breaker for (base_url, model).
+    When the breaker is open, route to the fallback endpoint if one is configured, otherwise fail fast.
+    """
+    if not palbreaker.allow_request(base_url, model):
+        if fallback is None and fallback_base_url and fallback_model:
+            fallback = {'openai_base_url': fallback_base_url, 'openai_model': fallback_model}
+        if fallback and (fallback['openai_base_url'], fallback['openai_model']) != (base_url, model):
+            print(f'Circuit open for {model}, falling back to {fallback["openai_model"]}', flush=True)
+            return await create_completion(
+                fallback['openai_base_url'], fallback['openai_model'], messages, max_tokens, temperature, fallback=False,
+            )
+        raise palbreaker.CircuitOpenError(base_url, model)
+
+    call_counter = provider_call_counter.get()
+    if call_counter is not None:
+        call_counter['calls'] += 1
+    try:
+        with paltrace.span('provider.completion', base_url=base_url, model=model, max_tokens=max_tokens):
+            response = await get_ai_client(base_url).chat.completions.create(
+                model=model,
+                messages=messages,  # noqa
+                max_tokens=max_tokens,
+                temperature=temperature,
+                timeout=provider_timeout,
+            )
+            if response.usage:
+                paltrace.set_attribute('prompt_tokens', response.usage.prompt_tokens)
+                paltrace.set_attribute('completion_tokens', response.usage.completion_tokens)
+    except asyncio.CancelledError:
+        palbreaker.get_breaker(base_url, model)['trial_in_flight'] = False
+        raise
+    except Exception as err:
+        if not is_provider_outage(err):
+            # The endpoint answered (e.g. a 4xx for a bad request), so it is not down
+            palbreaker.record_success(base_url, model)
+        elif palbreaker.record_failure(base_url, model, err):
+            start_background_task(probe_endpoint(base_url, model))
+        raise
+
+    palbreaker.record_success(base_url, model)
+    return response
+
+
+def is_provider_outage(err):
+    """
+    Return True for errors that suggest the endpoint is unavailable: timeouts, connection errors, 429 and 5xx.
+    """
+    import openai
+
+    if isinstance(err, (openai.APIConnectionError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(err, openai.APIStatusError):
+        return err.status_code == 429 or err.status_code >= 500
+    return False
+
+
+async def probe_endpoint(base_url, model):
+    """
+    Send a one-token completion to an open endpoint until it answers, then let the breaker go half-open.
+    """
+    while palbreaker.get_breaker(base_url, model)['state'] == palbreaker.OPEN:
+        await asyncio.sleep(palbreaker.probe_interval)
+        try:
+            await get_ai_client(base_url).chat.completions.create(
+                model=model,
+                messages=[{'role': 'user', 'content': 'ping'}],
+                max_tokens=1,
+                timeout=provider_timeout,
+            )
+            palbreaker.record_probe_success(base_url, model)
+        except Exception as err:
+            print(f'Probe failed for {model} at {base_url}: {err}', flush=True)
+
+
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+unsafe_filename_pattern = re.compile(r'[^a-z0-9_-]+')
+
 def format_audio_file(string):
-    string = string.replace(' ', '_').replace('$', '').lower()
-    string = string.replace('(', '').replace(')', '')
-    string = string.replace('{', '').replace('}', '')
-    string = string.replace('[', '').replace(']', '')
-    string = string.replace('.', '').replace(',', '')
-    string = string.replace('\\', '').replace("'", '').replace('"', '').replace('|', '')
-    return string
+    """
+    Turn a video title into a safe attachment filename stem (lowercase ASCII letters, digits, '_' and '-').
+    """
+    string = unsafe_filename_pattern.sub('', string.lower().replace(' ', '_'))
+    return string[:100] or 'audio'
 
 
 def format_response(response: str) -> str:
@@ -157,6 +340,16 @@ async def generate_system_prompt_metadata(event):
     return system_prompt
 
 
+command_prefix_pattern = re.compile(r'^\s*(online:|!online|hey pal\b)', flags=re.IGNORECASE)
+command_flag_pattern = re.compile(r'\+(history|citations)\b', flags=re.IGNORECASE)
+
+def strip_command_text(message_text):
+    """
+    Remove the command prefix and +flags from a message, leaving the question itself.
+    """
+    return command_flag_pattern.sub('', command_prefix_pattern.sub('', message_text)).strip()
+
+
 async def handle_message(event):
     channel_base_url = event.get('channel_base_url', '')
     channel_model = event.get('channel_model', '')
@@ -164,26 +357,17 @@ async def handle_message(event):
     message_text = event.get('message', '')
     system_prompt_footer = event.get('channel_context', '')
     channel_history = event.get('channel_history', '')
-    use_akash = bool('akash' in channel_base_url)
-    if use_akash:
-        selected_client = akash_client
-    else:
-        selected_client = openai_client
 
     try:
         messages = [
             {'role': 'system', 'content': channel_prompt + system_prompt_footer},
             {'role': 'user', 'content': message_text + channel_history},
         ]
-        response = await selected_client.chat.completions.create(
-            model=channel_model,
-            messages=messages,  # noqa
-            max_tokens=1024,
-            temperature=0.7,
-        )
+        response = await create_completion(channel_base_url, channel_model, messages, max_tokens=1024, temperature=0.7)
         # print(f'DEBUG Client response: {response}')
         result = response.choices[0].message.content
-        result = format_response(result)
+        with paltrace.span('format_response'):
+            result = format_response(result)
         is_refusal = bool(response.choices[0].message.refusal)
         if is_refusal:
             print(f'DEBUG Model has refused to answer this prompt: {response.choices[0].message.refusal}', flush=True)
@@ -193,6 +377,10 @@ async def handle_message(event):
             citations = []
 
         usage = response.usage
+        if usage:
+            palcache.counter_incr(f'{channel_model}:prompt_tokens', usage.prompt_tokens)
+            palcache.counter_incr(f'{channel_model}:completion_tokens', usage.completion_tokens)
+        palcache.counter_incr(f'{channel_model}:requests')
         print(f'openai response (length: {len(result)}):\n{result}', flush=True)
         print(f'DEBUG usage:\n{usage}', flush=True)
         print(f'DEBUG citations:\n{citations}', flush=True)
@@ -209,19 +397,23 @@ async def handle_message(event):
         return '', []
 
 
-# Global judgement cache
-judgement_cache = {}
+# Judgement cache (shared between shard processes)
+judgement_cache_ttl = 3600  # 1 hour
+judgement_cache_size = int(os.getenv('JUDGEMENT_CACHE_SIZE', '1000'))
+# Replies given when no judgement could be formed; these are never cached
+judgement_errors = {
+    'Unable to gather sufficient judgements.',
+    'Unable to formulate final judgement due to technical issues.',
+    'Unable to obtain judgement from fallback.',
+    'Judgement system temporarily unavailable.',
+}
 
 def get_cache_key(message_text):
     return hashlib.md5(message_text.encode()).hexdigest()
 
 async def check_judgement_cache(message_text):
     key = get_cache_key(message_text)
-    if key in judgement_cache:
-        cache_entry = judgement_cache[key]
-        if time.time() - cache_entry['timestamp'] < 3600:  # 1 hour
-            return cache_entry['result']
-    return None
+    return palcache.cache_get('judgement', key)
 
 def select_expert_judges(message_text):
     judges = [
@@ -276,24 +468,30 @@ def select_expert_judges(message_text):
 
     return judges
 
+# Per-judge latency totals, reported by the batch judgement CLI
+judge_stats = {}
+
+def record_judge_latency(name, elapsed):
+    stats = judge_stats.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+    stats['count'] += 1
+    stats['total'] += elapsed
+    stats['max'] = max(stats['max'], elapsed)
+
 async def get_single_judgement(judge, message_text):
+    start_time = time.perf_counter()
     try:
-        use_akash = bool('akash' in judge['openai_base_url'])
-        selected_client = akash_client if use_akash else openai_client
-
         judge_messages = [
             {'role': 'system', 'content': judge['prompt']},
             {'role': 'user', 'content': message_text},
         ]
-        response = await selected_client.chat.completions.create(
-            model=judge['openai_model'],
-            messages=judge_messages,  # noqa
-            max_tokens=512,
-            temperature=judge['temperature'],
+        response = await create_completion(
+            judge['openai_base_url'], judge['openai_model'], judge_messages,
+            max_tokens=512, temperature=judge['temperature'],
         )
 
         result = response.choices[0].message.content or ""
         print(f'{judge["name"]} judgement: {result}', flush=True)
+        record_judge_latency(judge['name'], time.perf_counter() - start_time)
 
         # Parse confidence
         confidence_match = re.search(r'Confidence: (\d+)/10', result)
@@ -305,28 +503,151 @@ async def get_single_judgement(judge, message_text):
         print(f'Error getting judgement from {judge["name"]}: {err}', flush=True)
         return {'content': f'Unable to obtain judgement from {judge["name"]}.', 'confidence': 1, 'name': judge['name']}
 
-async def get_judge_responses(judges, message_text):
-    tasks = []
+def group_judges(judges):
+    """
+    Group judges by (base URL, model), applying JUDGE_BATCH_MODEL when set.
+    """
+    groups = {}
+    for judge in judges:
+        if judge_batch_model:
+            judge = dict(judge, openai_model=judge_batch_model)
+        groups.setdefault((judge['openai_base_url'], judge['openai_model']), []).append(judge)
+    return list(groups.values())
+
+# Sections of a judge prompt that only describe how a single judge should reply
+persona_reply_sections = ('Response Format', 'Communication Style', 'Chat Boundaries')
+
+def persona_framework(prompt):
+    """
+    Return a judge prompt without its reply formatting sections, with headings nested under the persona.
+    The batched JSON format replaces them.
+    """
+    sections = re.split(r'^# ', prompt.strip(), flags=re.MULTILINE)
+    kept = [section for section in sections if section and not section.startswith(persona_reply_sections)]
+    return '\n'.join(f'## {section.strip()}' for section in kept)
+
+def parse_batched_judgements(result):
+    """
+    Parse the JSON reply of a batched judge call into {name: {'content', 'confidence'}}.
+    """
+    result = re.sub(r'<think>.*?</think>', '', result, flags=re.DOTALL)
+    json_match = re.search(r'\{.*\}', result, flags=re.DOTALL)
+    if not json_match:
+        return {}
+    try:
+        entries = json.loads(json_match.group(0)).get('judgements', [])
+    except (ValueError, AttributeError):
+        return {}
+
+    parsed = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get('name') or not entry.get('judgement'):
+            continue
+        try:
+            confidence = min(10, max(1, int(entry.get('confidence', 5))))
+        except (TypeError, ValueError):
+            confidence = 5
+        # Keep the per-judge content format so consensus detection and the final judge see the same text
+        parsed[entry['name']] = {
+            'content': f'{entry["judgement"]}\nConfidence: {confidence}/10',
+            'confidence': confidence,
+        }
+    return parsed
+
+async def get_batched_judgements(judges, message_text):
+    """
+    Ask every judge in a group for its judgement in one structured completion.
+    Judges missing from the reply are asked individually.
+    """
+    batch_prompt = '# Purpose\nYou are a panel of judges. Judge the statement separately as each persona below, '
+    batch_prompt += 'following that persona\'s framework. Do not let the personas influence each other.\n'
+    for judge in judges:
+        batch_prompt += f'# Persona: {judge["name"]}\n{persona_framework(judge["prompt"])}\n'
+    batch_prompt += '# Response Format\nRespond with JSON only, in this form:\n'
+    batch_prompt += '{"judgements": [{"name": "<persona name>", "judgement": "<judgement>", "confidence": <1-10>}]}\n'
+    batch_prompt += 'Include exactly one entry per persona: ' + ', '.join(judge['name'] for judge in judges) + '\n'
+    batch_prompt += 'Keep each judgement under 1000 characters and put its confidence only in the "confidence" field. '
+    batch_prompt += 'Do not add any text outside the JSON.\n'
+
+    start_time = time.perf_counter()
+    parsed = {}
+    try:
+        response = await create_completion(
+            judges[0]['openai_base_url'], judges[0]['openai_model'],
+            [{'role': 'system', 'content': batch_prompt}, {'role': 'user', 'content': message_text}],
+            max_tokens=512 * len(judges),
+            temperature=min(judge['temperature'] for judge in judges),
+        )
+        result = response.choices[0].message.content or ''
+        print(f'Batched judgement ({len(judges)} judges): {result}', flush=True)
+        parsed = parse_batched_judgements(result)
+    except Exception as err:
+        print(f'Error getting batched judgement from {judges[0]["openai_model"]}: {err}', flush=True)
+
+    elapsed = time.perf_counter() - start_time
+    missing = [judge for judge in judges if judge['name'] not in parsed]
+    if missing:
+        print(f'No batched judgement for {", ".join(judge["name"] for judge in missing)}, asking individually', flush=True)
+    individual = await asyncio.gather(*(get_single_judgement(judge, message_text) for judge in missing))
+    individual = {judgement['name']: judgement for judgement in individual}
+
+    judgements = []
     for judge in judges:
-        task = asyncio.create_task(get_single_judgement(judge, message_text))
-        tasks.append(task)
+        if judge['name'] in parsed:
+            record_judge_latency(judge['name'], elapsed)
+            judgements.append(dict(parsed[judge['name']], name=judge['name']))
+        else:
+            judgements.append(individual[judge['name']])
+    return judgements
+
+async def get_judge_responses(judges, message_text, batched=None):
+    if batched is None:
+        batched = judge_batching
+    if not batched:
+        tasks = []
+        for judge in judges:
+            task = asyncio.create_task(get_single_judgement(judge, message_text))
+            tasks.append(task)
 
-    return await asyncio.gather(*tasks)
+        return await asyncio.gather(*tasks)
+
+    tasks = []
+    for group in group_judges(judges):
+        if len(group) == 1:
+            tasks.append(asyncio.create_task(get_single_judgement(group[0], message_text)))
+        else:
+            tasks.append(asyncio.create_task(get_batched_judgements(group, message_text)))
+
+    # Return judgements in panel order, as the per-judge mode does
+    by_name = {}
+    for result in await asyncio.gather(*tasks):
+        for judgement in (result if isinstance(result, list) else [result]):
+            by_name[judgement['name']] = judgement
+    return [by_name[judge['name']] for judge in judges]
+
+# Negative verdicts are checked first, since "disapprove" and "not good" contain the positive words
+negative_verdict_pattern = re.compile(
+    r"\b(disapprov\w*|unacceptable|bad|(not|never|\w+n't)\s+(\w+\s+)?(good|acceptable|approv\w*))\b"
+)
+positive_verdict_pattern = re.compile(r'\b(approv\w*|good|acceptable)\b')
+
+def judgement_sentiment(content):
+    """
+    Classify a judgement as positive (1), negative (-1) or neutral (0).
+    """
+    content = content.lower()
+    if negative_verdict_pattern.search(content):
+        return -1
+    elif positive_verdict_pattern.search(content):
+        return 1
+    return 0
 
 def detect_consensus(judgements, threshold=0.8):
     if len(judgements) < 2:
         return False
 
     # Simple consensus: all judges agree on positive/negative outcome
-    sentiments = []
-    for judgement in judgements:
-        content = judgement['content'].lower()
-        if 'approve' in content or 'good' in content or 'acceptable' in content:
-            sentiments.append(1)
-        elif 'disapprove' in content or 'bad' in content or 'unacceptable' in content:
-            sentiments.append(-1)
-        else:
-            sentiments.append(0)
+    sentiments = [judgement_sentiment(judgement['content']) for judgement in judgements]
 
     agreement_ratio = sentiments.count(sentiments[0]) / len(sentiments) if sentiments else 0
     return agreement_ratio >= threshold and sentiments[0] != 0
@@ -337,6 +658,8 @@ async def get_final_judgement(judgements, message_text):
         'openai_base_url': openai_base_url,
         'openai_model': 'sonar-pro',
         'temperature': 0.4,
+        # Neutral Akash judge used while the online judge's circuit is open
+        'fallback': {'openai_base_url': akash_base_url, 'openai_model': 'Meta-Llama-3-3-70B-Instruct'},
     }
 
     # Combine judgements with confidence scores
@@ -349,18 +672,13 @@ async def get_final_judgement(judgements, message_text):
 
     try:
         print(f'\nFinal Judge Context:\n{judgement_context}\n', flush=True)
-        use_akash = bool('akash' in final_judge['openai_base_url'])
-        selected_client = akash_client if use_akash else openai_client
-
         final_messages = [
             {'role': 'system', 'content': final_judge['prompt']},
             {'role': 'user', 'content': judgement_context},
         ]
-        judgement_response = await selected_client.chat.completions.create(
-            model=final_judge['openai_model'],
-            messages=final_messages,  # noqa
-            max_tokens=512,
-            temperature=final_judge['temperature'],
+        judgement_response = await create_completion(
+            final_judge['openai_base_url'], final_judge['openai_model'], final_messages,
+            max_tokens=512, temperature=final_judge['temperature'], fallback=final_judge['fallback'],
         )
 
         judgement_result = judgement_response.choices[0].message.content
@@ -380,6 +698,7 @@ async def provide_judgement(event):
     cached_result = await check_judgement_cache(message_text)
     if cached_result:
         print('Returning cached judgement', flush=True)
+        palcache.counter_incr('judgement:cache_hits')
         return cached_result
 
     try:
@@ -402,8 +721,9 @@ async def provide_judgement(event):
             result = await get_final_judgement(judgements, message_text)
 
         # Cache the result
-        key = get_cache_key(message_text)
-        judgement_cache[key] = {'result': result, 'timestamp': time.time()}
+        if result not in judgement_errors:
+            key = get_cache_key(message_text)
+            palcache.cache_set('judgement', key, result, judgement_cache_ttl, max_entries=judgement_cache_size)
 
         return result
 
@@ -424,14 +744,172 @@ async def provide_judgement(event):
             return "Judgement system temporarily unavailable."
 
 
-async def get_channel_messages(event, limit=10):
-    channel_obj = discord_client.get_channel(event.get('channel_id'))
-    response = '# Begin Context: Channel Message History\n'
-    async for msg in channel_obj.history(limit=limit):
-        if msg.author == event.get('is_me', ''):
-            response += f'{msg.author}: [AI GENERATED CONTENT]\n'
-        else:
-            response += f'{msg.author}: {msg.content}\n'
+# Per-channel memory: running summary plus the raw messages not yet folded into it
+channel_memory = {}
+
+
+def format_history_line(msg, is_me):
+    if msg.author == is_me:
+        return f'{msg.author}: [AI GENERATED CONTENT]'
+    return f'{msg.author}: {msg.content}'
+
+
+def record_channel_message(message):
+    """
+    Index the message and append it to its channel buffer, once the buffer has been seeded from Discord.
+    """
+    if message.author != discord_client.user:
+        palindex.add_message(message.channel.id, message.id, str(message.author), message.content)
+    memory = channel_memory.get(message.channel.id)
+    if memory is None:
+        if message.channel.id in prefetched_history:
+            prefetched_history[message.channel.id].append(message)
+        return
+    memory['messages'].append(format_history_line(message, discord_client.user))
+    memory['message_ids'].append(message.id)
+    if len(memory['message_ids']) > summary_buffer_max:
+        # The summary model has been failing for a while; drop the oldest messages rather than grow without limit
+        drop_channel_messages(memory, set(memory['message_ids'][:-summary_buffer_max]))
+    maybe_summarize_channel(message.channel.id)
+
+
+def update_channel_message(message):
+    """
+    Apply an edit to the index and to the channel buffer, if the message is still in it.
+    """
+    if message.author != discord_client.user:
+        palindex.update_message(message.channel.id, message.id, message.content)
+    if message.channel.id in prefetched_history:
+        prefetched_history[message.channel.id] = [
+            message if prefetched.id == message.id else prefetched for prefetched in prefetched_history[message.channel.id]
+        ]
+    memory = channel_memory.get(message.channel.id)
+    if memory is None or message.id not in memory['message_ids']:
+        return
+    memory['messages'][memory['message_ids'].index(message.id)] = format_history_line(message, discord_client.user)
+
+
+def delete_channel_message(channel_id, message_id):
+    """
+    Remove a deleted message from the index and from the channel buffer.
+    """
+    palindex.delete_message(channel_id, message_id)
+    if channel_id in prefetched_history:
+        prefetched_history[channel_id] = [msg for msg in prefetched_history[channel_id] if msg.id != message_id]
+    memory = channel_memory.get(channel_id)
+    if memory is not None:
+        drop_channel_messages(memory, {message_id})
+
+
+def drop_channel_messages(memory, message_ids):
+    """
+    Remove messages from a channel buffer by ID, so the buffer can change while a summary is in flight.
+    """
+    keep = [index for index, message_id in enumerate(memory['message_ids']) if message_id not in message_ids]
+    memory['messages'] = [memory['messages'][index] for index in keep]
+    memory['message_ids'] = [memory['message_ids'][index] for index in keep]
+
+
+def maybe_summarize_channel(channel_id):
+    """
+    Fold the oldest messages into the channel summary in the background once the buffer passes the threshold,
+    at most summary_fold_max at a time.
+    """
+    memory = channel_memory[channel_id]
+    if memory['summarizing'] or len(memory['messages']) <= summary_threshold:
+        return
+    if time.monotonic() < memory['retry_at']:
+        return
+    memory['summarizing'] = True
+    fold_count = min(len(memory['messages']) - summary_tail, summary_fold_max)
+    start_background_task(summarize_channel(channel_id, fold_count))
+
+
+async def summarize_channel(channel_id, fold_count):
+    memory = channel_memory[channel_id]
+    older_messages = memory['messages'][:fold_count]
+    older_ids = set(memory['message_ids'][:fold_count])
+    summary_context = '# Purpose\nUpdate the running summary of this Discord channel with the new messages below. '
+    summary_context += 'Keep names, decisions, open questions and facts that later messages may refer to. '
+    summary_context += 'Respond with the updated summary only, in less than 1500 characters.\n'
+    summary_context += f'# Current Summary\n{memory["summary"] or "(none)"}\n'
+    summary_context += '# New Messages\n' + '\n'.join(older_messages) + '\n'
+    try:
+        response = await create_completion(
+            summary_base_url, summary_model, [{'role': 'user', 'content': summary_context}],
+            max_tokens=512, temperature=0.2,
+        )
+        summary = format_response(response.choices[0].message.content or '')
+        if not summary:
+            raise ValueError('empty summary')
+        memory['summary'] = summary
+        drop_channel_messages(memory, older_ids)
+        memory['retry_delay'] = 0
+        print(f'Summarized {fold_count} messages for channel {channel_id}', flush=True)
+    except Exception as err:
+        # Keep the unsummarized messages and back off before trying again
+        memory['retry_delay'] = min(summary_retry_max, max(30, memory['retry_delay'] * 2))
+        memory['retry_at'] = time.monotonic() + memory['retry_delay']
+        print(f'Error summarizing channel {channel_id}, retrying in {memory["retry_delay"]}s: {err}', flush=True)
+    finally:
+        memory['summarizing'] = False
+    # A backlog is folded in steps of summary_fold_max until the buffer is back under the threshold
+    maybe_summarize_channel(channel_id)
+
+
+async def fetch_channel_history(channel_id):
+    """
+    Return the last SUMMARY_THRESHOLD messages of a channel from Discord, oldest first.
+    """
+    channel_obj = discord_client.get_channel(channel_id)
+    with paltrace.span('discord.history', channel_id=channel_id, limit=summary_threshold):
+        history = [msg async for msg in channel_obj.history(limit=summary_threshold)]
+    return list(reversed(history))
+
+
+async def get_channel_messages(event):
+    """
+    Build the history context for a +history request: running summary, relevant earlier messages and recent tail.
+    The channel buffer is seeded from Discord on the first request, after which on_message keeps it current.
+    """
+    channel_id = event.get('channel_id')
+    memory = channel_memory.get(channel_id)
+    if memory is None:
+        # Seed the buffer the first time history is requested in this channel, from a warm prefetch if there is one
+        history = prefetched_history.pop(channel_id, None)
+        if not history or prefetch_expiry.get(channel_id, 0) <= time.monotonic():
+            history = await fetch_channel_history(channel_id)
+        memory = {
+            'summary': '',
+            'messages': [format_history_line(msg, event.get('is_me', '')) for msg in history],
+            'message_ids': [msg.id for msg in history],
+            'summarizing': False,
+            'retry_delay': 0,
+            'retry_at': 0.0,
+        }
+        channel_memory[channel_id] = memory
+
+    # Only the last SUMMARY_TAIL messages are sent; older unfolded ones can still come back through the index
+    recent_messages = memory['messages'][-summary_tail:]
+    recent_ids = memory['message_ids'][-summary_tail:]
+    response = ''
+    if memory['summary']:
+        response += '# Begin Context: Channel Summary\n'
+        response += memory['summary'] + '\n'
+        response += '# End Context: Channel Summary\n'
+    if '+history' in event.get('message', '') and index_top_k > 0:
+        with paltrace.span('index.search', channel_id=channel_id):
+            relevant_messages = palindex.search(
+                channel_id, strip_command_text(event['message']), index_top_k, exclude_ids=recent_ids,
+            )
+        if relevant_messages:
+            response += '# Begin Context: Relevant Earlier Messages\n'
+            for author, content in relevant_messages:
+                response += f'{author}: {content}\n'
+            response += '# End Context: Relevant Earlier Messages\n'
+    response += '# Begin Context: Channel Message History\n'
+    for line in recent_messages:
+        response += f'{line}\n'
 
     response += '# End Context: Channel Message History\n'
     print(f'\n{response}', flush=True)
@@ -445,77 +923,98 @@ async def send_message(msg_obj, msg_txt):
         for i in range(0, len(msg_txt), 2000):
             chunk = msg_txt[i:i + 2000]
             try:
-                await msg_obj.channel.send(chunk)
+                with paltrace.span('discord.send', length=len(chunk)):
+                    await msg_obj.channel.send(chunk)
             except Exception as err:
                 print(f'Error sending message: {err}')
 
 
+youtube_video_pattern = r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([a-zA-Z0-9_-]{11})'
+youtube_playlist_pattern = r'(?:https?://)?(?:www\.)?youtube\.com/playlist\?list=([a-zA-Z0-9_-]+)'
+
+
 def is_youtube_url(text):
     """
-    Check if the message contains a YouTube URL.
+    Check if the message contains a YouTube video or playlist URL.
+    """
+    return bool(re.search(youtube_video_pattern, text) or re.search(youtube_playlist_pattern, text))
+
+
+def run_yt_dlp(url, ydl_opts, cancel_event):
     """
-    youtube_pattern = r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([a-zA-Z0-9_-]{11})'
-    return bool(re.search(youtube_pattern, text))
+    Download and convert with yt-dlp (blocking, run in a worker thread).
+    Setting cancel_event aborts the download or conversion at the next progress callback.
+    Returns the video title.
+    """
+    import yt_dlp
+
+    def check_cancelled(status):
+        if cancel_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled('Download cancelled')
 
+    # noplaylist keeps a watch URL with a list= parameter to the one video; playlists are expanded by handle_youtube
+    ydl_opts = dict(ydl_opts, noplaylist=True, progress_hooks=[check_cancelled], postprocessor_hooks=[check_cancelled])
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        # Extract and download in one pass so the page is only fetched once
+        info = ydl.extract_info(url, download=True)
+        title = info.get('title', 'unknown')
+        print(f'Video title: {title}', flush=True)
+    return title
 
-async def download_youtube_as_audio_only(url, start_quality='192'):
+
+async def download_youtube_as_audio_only(url, scratch_dir, start_quality='192'):
     """
-    Download YouTube video and convert to audio file.
-    Returns the path to the audio file or None if failed.
+    Download YouTube video and convert to audio file inside scratch_dir.
+    Returns (audio_path, title) or None if failed.
     """
     print(f'Starting YouTube download for URL: {url}', flush=True)
     qualities = ['192', '128'] if start_quality == '192' else ['128', '192']
     for quality in qualities:
         try:
-            # Create temporary directory for download
-            with tempfile.TemporaryDirectory() as temp_dir:
-                random_bytes = os.urandom(32)
-                hash_value = hashlib.sha256(random_bytes).hexdigest()
-                output_path = os.path.join(temp_dir, hash_value)
-                # yt-dlp options for audio file conversion
-                ydl_ext = 'm4a'
-                ydl_opts = {
-                    'format': 'm4a/bestaudio/best',
-                    'postprocessors': [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': ydl_ext,
-                        'preferredquality': quality,
-                    }],
-                    'outtmpl': output_path,
-                    'quiet': False,
-                    'no_warnings': True,
-                }
-
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    # Extract info first to get title
-                    print(f'Extracting video info for quality {quality}...', flush=True)
-                    info = ydl.extract_info(url, download=False)
-                    title = info.get('title', 'unknown')
-                    print(f'Video title: {title}', flush=True)
-                    # Download and convert
-                    print(f'Downloading and converting with quality {quality}...', flush=True)
-                    ydl.download([url])
-                    print(f'Download and conversion completed for quality {quality}', flush=True)
-                    print(f'Temporary path: {output_path}', flush=True)
-                    extracted_audio_path = output_path + f'.{ydl_ext}'
-                    if os.path.exists(extracted_audio_path):
-                        # Check file size (Discord limit is 10MB)
-                        file_size = os.path.getsize(extracted_audio_path)
-                        print(f'Generated file size: {file_size} bytes', flush=True)
-                        if file_size > 10 * 1024 * 1024:  # 10MB
-                            print(f'File too large ({file_size} bytes > 10MB), trying next quality', flush=True)
-                            continue  # Try next quality
-
-                        # Move to a persistent location for upload
-                        title = format_audio_file(title)
-                        final_path = f'/tmp/{title}.{ydl_ext}'
-                        print(f'Moving audio file to: {final_path}', flush=True)
-                        os.rename(extracted_audio_path, final_path)
-                        return final_path
-                    else:
-                        print(f'Failed to locate download: {extracted_audio_path}', flush=True)
-
-            return None
+            output_path = os.path.join(scratch_dir, f'audio-{quality}')
+            # yt-dlp options for audio file conversion
+            ydl_ext = 'm4a'
+            ydl_opts = {
+                'format': 'm4a/bestaudio/best',
+                'postprocessors': [{
+                    'key': 'FFmpegExtractAudio',
+                    'preferredcodec': ydl_ext,
+                    'preferredquality': quality,
+                }],
+                'outtmpl': output_path,
+                'paths': {'home': scratch_dir, 'temp': scratch_dir},
+                'quiet': False,
+                'no_warnings': True,
+            }
+
+            # Run yt-dlp off the event loop so it can be cancelled without blocking other events
+            cancel_event = threading.Event()
+            print(f'Downloading with quality {quality}...', flush=True)
+            worker = asyncio.ensure_future(asyncio.to_thread(run_yt_dlp, url, ydl_opts, cancel_event))
+            try:
+                with paltrace.span('youtube.download', url=url, quality=quality):
+                    title = await asyncio.shield(worker)
+            except asyncio.CancelledError:
+                # Wait for the worker thread to stop so the scratch directory is not removed while it still writes there
+                cancel_event.set()
+                with contextlib.suppress(Exception):
+                    await asyncio.shield(worker)
+                raise
+            print(f'Download and conversion completed for quality {quality}', flush=True)
+            extracted_audio_path = output_path + f'.{ydl_ext}'
+            if not os.path.exists(extracted_audio_path):
+                print(f'Failed to locate download: {extracted_audio_path}', flush=True)
+                continue
+
+            # Check file size (Discord limit is 10MB)
+            file_size = os.path.getsize(extracted_audio_path)
+            print(f'Generated file size: {file_size} bytes', flush=True)
+            if file_size > 10 * 1024 * 1024:  # 10MB
+                print(f'File too large ({file_size} bytes > 10MB), trying next quality', flush=True)
+                os.remove(extracted_audio_path)
+                continue  # Try next quality
+
+            return extracted_audio_path, title
 
         except Exception as err:
             print(f'Error downloading/converting YouTube video with quality {quality}: {err}', flush=True)
@@ -526,46 +1025,240 @@ async def download_youtube_as_audio_only(url, start_quality='192'):
     return None
 
 
+@contextlib.contextmanager
+def audio_scratch():
+    """
+    Create a private scratch directory for one audio job and always remove it afterwards.
+    """
+    scratch_dir = tempfile.mkdtemp(prefix=audio_scratch_prefix, dir=audio_scratch_root)
+    try:
+        yield scratch_dir
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def purge_audio_scratch(max_age=3600):
+    """
+    Remove scratch directories left behind by a crashed process.
+    Only directories older than max_age are removed, so jobs in other shard processes are left alone.
+    """
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(audio_scratch_root))
+    except OSError as err:
+        print(f'Unable to scan audio scratch root {audio_scratch_root}: {err}', flush=True)
+        return
+    for entry in entries:
+        try:
+            if entry.name.startswith(audio_scratch_prefix) and entry.is_dir() and entry.stat().st_mtime < cutoff:
+                print(f'Removing stale audio scratch directory: {entry.path}', flush=True)
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def make_audio_file(audio_path, title):
+    """
+    Build the Discord attachment. The sanitized title is only used as the attachment filename.
+    With AUDIO_IN_MEMORY the bytes are read into memory and the scratch file is removed before upload.
+    """
+    filename = f'{format_audio_file(title)}.m4a'
+    if audio_in_memory:
+        with open(audio_path, 'rb') as audio_file:
+            audio_bytes = io.BytesIO(audio_file.read())
+        os.remove(audio_path)
+        return discord.File(audio_bytes, filename=filename)
+    return discord.File(audio_path, filename=filename)
+
+
+async def extract_youtube_metadata(url):
+    """
+    Resolve a video or playlist URL into a list of {'url', 'title'} items without downloading.
+    """
+    def extract():
+        import yt_dlp
+
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'extract_flat': 'in_playlist',
+            'playlistend': audio_max_items,
+        }
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    try:
+        info = await asyncio.to_thread(extract)
+    except Exception as err:
+        print(f'Error extracting metadata for {url}: {err}', flush=True)
+        if re.match(youtube_playlist_pattern, url):
+            # Downloading the playlist URL itself would fetch every entry, so report it as failed instead
+            return [{'url': url, 'title': url, 'status': 'failed'}]
+        return [{'url': url, 'title': url}]
+
+    if not info:
+        print(f'No metadata found for {url}', flush=True)
+        return []
+    if info.get('entries') is not None:
+        return [
+            {'url': f'https://youtu.be/{entry["id"]}', 'title': entry.get('title') or entry['id']}
+            for entry in info['entries'] if entry and entry.get('id')
+        ]
+    return [{'url': url, 'title': info.get('title', url)}]
+
+
+def cache_uploaded_audio(url, uploaded_message):
+    """
+    Remember where the audio for url was uploaded so a repeat request can reuse the attachment.
+    """
+    if audio_cache_ttl > 0:
+        palcache.cache_set(
+            'audio', url, {'channel_id': uploaded_message.channel.id, 'message_id': uploaded_message.id},
+            audio_cache_ttl, max_entries=audio_cache_size,
+        )
+
+
+async def get_cached_audio(url):
+    """
+    Fetch the attachment previously uploaded for url from Discord, or return None if there is none or it is gone.
+    """
+    cached = palcache.cache_get('audio', url) if audio_cache_ttl > 0 else None
+    if not cached:
+        return None
+    try:
+        channel = discord_client.get_channel(cached['channel_id']) or await discord_client.fetch_channel(cached['channel_id'])
+        uploaded_message = await channel.fetch_message(cached['message_id'])
+        audio_file = await uploaded_message.attachments[0].to_file()
+    except Exception as err:
+        print(f'Cached audio for {url} is no longer available: {err}', flush=True)
+        return None
+    print(f'Reusing cached audio for {url}', flush=True)
+    palcache.counter_incr('audio:cache_hits')
+    return audio_file
+
+
+def render_audio_status(items):
+    status = f'Processing {len(items)} audio requests:\n'
+    for index, item in enumerate(items, start=1):
+        status += f'> {index}. {item["title"][:80]} - {item["status"]}\n'
+    return status
+
+
 async def handle_youtube(message, event):
     await message.add_reaction('🎵')
     print('Processing YouTube link...\n', flush=True)
 
-    # Extract YouTube URL from message
-    yt_match_pattern = r'(?:https?://)?(?:www\.)?(?:youtube\.com/watch\?v=|youtu\.be/|youtube\.com/embed/)([a-zA-Z0-9_-]{11})'
-    youtube_urls = re.findall(yt_match_pattern, message.content)
-    if youtube_urls:
-        youtube_url = f'https://youtu.be/{youtube_urls[0]}'
-        audio_file_path = await download_youtube_as_audio_only(youtube_url)
+    # Extract YouTube video and playlist URLs from the message, in the order they were given
+    urls = []
+    for match in re.finditer(f'{youtube_playlist_pattern}|{youtube_video_pattern}', message.content):
+        if match.group(1):
+            url = f'https://www.youtube.com/playlist?list={match.group(1)}'
+        else:
+            url = f'https://youtu.be/{match.group(2)}'
+        if url not in urls:
+            urls.append(url)
+    if not urls:
+        return
 
-        if audio_file_path:
-            try:
-                await message.channel.send(file=discord.File(audio_file_path))
-                print(f'Successfully uploaded audio file: {audio_file_path}', flush=True)
-            except Exception as err:
-                print(f'Error uploading audio file with initial quality: {err}', flush=True)
-                # Retry with lower quality (128)
-                audio_file_path2 = await download_youtube_as_audio_only(youtube_url, start_quality='128')
-                if audio_file_path2:
+    # Resolve metadata for every URL at the same time
+    items = []
+    for resolved in await asyncio.gather(*(extract_youtube_metadata(url) for url in urls)):
+        for item in resolved:
+            if item['url'] not in [existing['url'] for existing in items]:
+                items.append(dict({'status': 'queued'}, **item))
+    items = items[:audio_max_items]
+    if not items:
+        await message.channel.send('Sorry, I couldn\'t convert that YouTube video to audio file. It might be too long or unavailable.')
+        return
+
+    # Multiple items get a status message that is edited as each one progresses
+    status_message = None
+    if len(items) > 1:
+        status_message = await message.channel.send(render_audio_status(items))
+
+    async def set_status(item, status):
+        item['status'] = status
+        if status_message is None:
+            return
+        try:
+            await status_message.edit(content=render_audio_status(items))
+        except Exception as err:
+            print(f'Error updating audio status message: {err}', flush=True)
+
+    # Downloads run under the concurrency cap; uploads happen in order as soon as the previous item is uploaded
+    semaphore = asyncio.Semaphore(audio_concurrency)
+    upload_turns = [asyncio.Event() for _ in items]
+
+    async def process_item(index, item):
+        try:
+            with audio_scratch() as scratch_dir:
+                cached_file = None
+                download = None
+                if item['status'] != 'failed':
+                    async with semaphore:
+                        await set_status(item, 'downloading')
+                        cached_file = await get_cached_audio(item['url'])
+                        if cached_file is None:
+                            download = await download_youtube_as_audio_only(item['url'], scratch_dir)
+                if index > 0:
+                    await upload_turns[index - 1].wait()
+                if cached_file is not None:
+                    await set_status(item, 'uploading')
                     try:
-                        await message.channel.send(file=discord.File(audio_file_path2))
-                        print(f'Successfully uploaded audio file on retry: {audio_file_path2}', flush=True)
-                    except Exception as err2:
-                        print(f'Error uploading audio file on retry: {err2}', flush=True)
-                        await message.channel.send('Sorry, there was an error uploading the audio file file.')
-                    finally:
-                        try:
-                            os.remove(audio_file_path2)
-                        except:
-                            pass
-                else:
-                    await message.channel.send('Sorry, I couldn\'t convert that YouTube video to audio file. It might be too long or unavailable.')
-            finally:
-                try:
-                    os.remove(audio_file_path)
-                except:
-                    pass
-        else:
+                        await message.channel.send(file=cached_file)
+                        await set_status(item, 'done')
+                    except Exception as err:
+                        print(f'Error uploading cached audio file: {err}', flush=True)
+                        await set_status(item, 'failed')
+                    return
+                if not download:
+                    await set_status(item, 'failed')
+                    if status_message is None:
+                        await message.channel.send('Sorry, I couldn\'t convert that YouTube video to audio file. It might be too long or unavailable.')
+                    return
+                await set_status(item, 'uploading')
+                uploaded = await upload_audio(
+                    message, item['url'], scratch_dir, download, notify=status_message is None, semaphore=semaphore,
+                )
+                await set_status(item, 'done' if uploaded else 'failed')
+        finally:
+            upload_turns[index].set()
+
+    await asyncio.gather(*(process_item(index, item) for index, item in enumerate(items)))
+
+
+async def upload_audio(message, url, scratch_dir, download, notify=True, semaphore=None):
+    """
+    Upload a downloaded audio file, retrying once from 128 kbps if the upload fails.
+    The retry download runs under semaphore, when given, so it counts toward AUDIO_CONCURRENCY.
+    With notify, failures are reported in the channel. Returns True if the file was uploaded.
+    """
+    try:
+        uploaded_message = await message.channel.send(file=make_audio_file(*download))
+        cache_uploaded_audio(url, uploaded_message)
+        print(f'Successfully uploaded audio file: {download[1]}', flush=True)
+        return True
+    except Exception as err:
+        print(f'Error uploading audio file with initial quality: {err}', flush=True)
+
+    # Retry with lower quality (128)
+    async with semaphore or contextlib.nullcontext():
+        download = await download_youtube_as_audio_only(url, scratch_dir, start_quality='128')
+    if not download:
+        if notify:
             await message.channel.send('Sorry, I couldn\'t convert that YouTube video to audio file. It might be too long or unavailable.')
+        return False
+
+    try:
+        uploaded_message = await message.channel.send(file=make_audio_file(*download))
+        cache_uploaded_audio(url, uploaded_message)
+        print(f'Successfully uploaded audio file on retry: {download[1]}', flush=True)
+        return True
+    except Exception as err2:
+        print(f'Error uploading audio file on retry: {err2}', flush=True)
+        if notify:
+            await message.channel.send('Sorry, there was an error uploading the audio file file.')
+        return False
 
 
 async def handle_guidance(message, event):
@@ -575,24 +1268,75 @@ async def handle_guidance(message, event):
     await send_message(message, judgement_response)
 
 
+def get_online_cache_key(message_text, model, prompt_name):
+    """
+    Normalize an online query (command prefix, flags, case, punctuation and spacing) into a cache key
+    for the model and system prompt that answer it.
+    """
+    query = re.sub(r'[^\w\s]', '', strip_command_text(message_text).lower())
+    query = ' '.join(query.split())
+    return hashlib.md5(f'{model}:{prompt_name}:{query}'.encode()).hexdigest()
+
+
 async def handle_online(message, event):
     await message.add_reaction('👍')
     print('Searching the interwebs...\n', flush=True)
     event.update({'channel_model': 'sonar-pro'})
-    if not '+history' in message.content:
-        event.update({'channel_history': ''})
+    use_history = '+history' in message.content
+    event.update({'channel_history': await get_channel_messages(event) if use_history else ''})
+
+    # Answers that depend on channel history are never cached
+    channel_config = channel_settings.get(message.channel.name, channel_settings['default'])
+    use_cache = online_cache_ttl > 0 and not use_history and channel_config.get('online_cache', True)
+    if use_cache:
+        # Cached answers are shared across users and servers, so leave out the per-user Discord metadata
+        event.update({'channel_context': ''})
+    cache_key = get_online_cache_key(message.content, event['channel_model'], channel_config.get('system_prompt'))
+    cached = palcache.cache_get('online', cache_key) if use_cache else None
+    if cached:
+        print('Returning cached online answer', flush=True)
+        palcache.counter_incr('online:cache_hits')
+        response, citations = cached['response'], cached['citations']
+    else:
+        response, citations = await handle_message(event)
+        if use_cache and response:
+            palcache.cache_set(
+                'online', cache_key, {'response': response, 'citations': citations},
+                online_cache_ttl, max_entries=online_cache_size,
+            )
 
-    response, citations = await handle_message(event)
     await send_message(message, response)
     if citations and '+citations' in message.content:
         await send_message(message, citations)
 
 
+async def handle_breakers(message, event):
+    states = palbreaker.breaker_states()
+    if not states:
+        await send_message(message, 'No provider endpoints have been used yet.')
+        return
+    status = 'Provider circuit breakers:\n'
+    for endpoint, state in states.items():
+        status += f'> {endpoint}: {state["state"]} (failures: {state["failures"]}, open for: {state["open_for"]}s)\n'
+    await send_message(message, status)
+
+
+async def handle_usage(message, event):
+    counters = palcache.counter_values()
+    if not counters:
+        await send_message(message, 'No usage has been recorded yet.')
+        return
+    usage = 'Usage counters (all shards):\n'
+    for name, value in sorted(counters.items()):
+        usage += f'> {name}: {value}\n'
+    await send_message(message, usage)
+
+
 async def handle_pal(message, event):
     await message.add_reaction('👍')
     print('Handling message...\n', flush=True)
-    if not '+history' in message.content:
-        event.update({'channel_history': ''})
+    if '+history' in message.content:
+        event.update({'channel_history': await get_channel_messages(event)})
 
     response, citations = await handle_message(event)
     await send_message(message, response)
@@ -612,6 +1356,14 @@ command_dispatcher = [
         'condition': lambda msg: msg.content.startswith(('guidance:', '!guidance', 'judgement:', '!judgement')),
         'handler': handle_guidance,
     },
+    {
+        'condition': lambda msg: msg.content.startswith('!breakers'),
+        'handler': handle_breakers,
+    },
+    {
+        'condition': lambda msg: msg.content.startswith('!usage'),
+        'handler': handle_usage,
+    },
     {
         'condition': lambda msg: msg.content.startswith('online:') or msg.content.startswith('!online'),
         'handler': handle_online,
@@ -623,14 +1375,95 @@ command_dispatcher = [
 ]
 
 
-@discord_client.event
 async def on_ready():
     print(f'{discord_client.user} has connected to Discord!', flush=True)
+    if shard_count > 0:
+        print(f'Running shards {sorted(discord_client.shards)} of {shard_count}', flush=True)
+    palcache.cache_purge()
+    purge_audio_scratch()
 
     return
 
-@discord_client.event
 async def on_message(message):
+    with paltrace.span('on_message', message_id=message.id, channel_id=message.channel.id):
+        record_channel_message(message)
+        await dispatch_message(message)
+
+
+async def on_typing(channel, user, when):
+    """
+    Warm a prefetch channel when someone starts typing, at most once per PREFETCH_TTL.
+    """
+    if getattr(channel, 'name', None) not in prefetch_channels or user.bot:
+        return
+    now = time.monotonic()
+    if prefetch_expiry.get(channel.id, 0) > now:
+        return
+    # Forget expired prefetches so neither map grows with every channel ever typed in
+    for channel_id in [channel_id for channel_id, expires in prefetch_expiry.items() if expires <= now]:
+        del prefetch_expiry[channel_id]
+        prefetched_history.pop(channel_id, None)
+    prefetch_expiry[channel.id] = now + prefetch_ttl
+    start_background_task(prefetch_channel(channel))
+
+
+async def prefetch_channel(channel):
+    """
+    Fetch recent history for an untracked channel and open a pooled connection to its model endpoint.
+    The history is only kept until the prefetch expires, so typing alone never starts tracking a channel.
+    """
+    channel_config = channel_settings.get(channel.name, channel_settings['default'])
+    base_url = channel_config.get('openai_base_url')
+    model = channel_config.get('openai_model')
+    print(f'Prefetching context for channel {channel.name}', flush=True)
+    try:
+        if channel.id not in channel_memory:
+            # Collect messages that arrive while the history is fetched, then merge them in
+            prefetched_history[channel.id] = []
+            history = await fetch_channel_history(channel.id)
+            if channel.id in prefetched_history:
+                seen = {msg.id for msg in history}
+                prefetched_history[channel.id] = history + [
+                    msg for msg in prefetched_history[channel.id] if msg.id not in seen
+                ]
+        if palbreaker.get_breaker(base_url, model)['state'] == palbreaker.CLOSED:
+            # Any response (even an error status) leaves a warm TLS connection in the pool
+            await get_ai_client(base_url).with_options(timeout=5).models.list()
+    except Exception as err:
+        print(f'Prefetch for channel {channel.name} did not complete: {err}', flush=True)
+
+
+async def on_message_edit(before, after):
+    """
+    Update the edited message in the index and channel buffer, and re-run its command if the previous run is still in flight.
+    """
+    if before.content == after.content:
+        return
+    update_channel_message(after)
+    if not cancel_inflight(before.id, 'edited'):
+        return
+    with paltrace.span('on_message_edit', message_id=after.id, channel_id=after.channel.id):
+        await dispatch_message(after)
+
+
+async def on_raw_message_delete(payload):
+    delete_channel_message(payload.channel_id, payload.message_id)
+    cancel_inflight(payload.message_id, 'deleted')
+
+
+def cancel_inflight(message_id, reason):
+    """
+    Cancel the handler task triggered by message_id. Returns True if one was running.
+    """
+    task = inflight_tasks.pop(message_id, None)
+    if task is None or task.done():
+        return False
+    print(f'Message {message_id} was {reason}, cancelling in-flight work', flush=True)
+    task.cancel()
+    return True
+
+
+async def dispatch_message(message):
     event = {}
     if message.author == discord_client.user:
         # Loop avoidance.
@@ -657,22 +1490,139 @@ async def on_message(message):
             'server_name': message.guild.name,
             'message': message.content,
         }
-        message_history = await get_channel_messages(event)
-        event.update({'channel_history': message_history})
-        channel_context = await generate_system_prompt_metadata(event)
-        event.update({'channel_context': channel_context})
     except Exception as err:
         print(f'Unable to setup event dictionary: {err}', flush=True)
 
-    # Dispatch commands using the command dispatcher
+    # Dispatch commands using the command dispatcher, tracking the handler so edits and deletes can cancel it.
+    # The task is registered before anything is awaited so an edit or delete can never slip in unseen.
     for command in command_dispatcher:
         if command['condition'](message):
-            await command['handler'](message, event)
+            with paltrace.span('dispatch', handler=command['handler'].__name__):
+                task = asyncio.create_task(run_handler(command['handler'], message, event))
+                inflight_tasks[message.id] = task
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    # Only an edit or delete (cancel_inflight) is handled here; cancelling this event task itself,
+                    # e.g. at shutdown, must still propagate
+                    if not task.cancelled() or asyncio.current_task().cancelling():
+                        raise
+                    print(f'Cancelled handling of message {message.id}', flush=True)
+                    paltrace.set_attribute('cancelled', True)
+                finally:
+                    if inflight_tasks.get(message.id) is task:
+                        del inflight_tasks[message.id]
             break
 
 
+async def run_handler(handler, message, event):
+    """
+    Add the channel context to the event, then run the command handler.
+    """
+    try:
+        event['channel_context'] = await generate_system_prompt_metadata(event)
+    except Exception as err:
+        print(f'Unable to setup event dictionary: {err}', flush=True)
+    await handler(message, event)
+
+
+def build_discord_client():
+    """
+    Construct the Discord client (sharded when SHARD_COUNT is set) and register the event handlers.
+    """
+    global discord_client
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.guilds = True
+    intents.guild_messages = True
+    if shard_count > 0:
+        discord_client = discord.AutoShardedClient(intents=intents, shard_count=shard_count, shard_ids=shard_ids or None)
+    else:
+        discord_client = discord.Client(intents=intents)
+    print(f'DEBUG discord_client: {discord_client}', flush=True)
+
+    discord_client.event(on_ready)
+    discord_client.event(on_message)
+    discord_client.event(on_message_edit)
+    if prefetch_channels:
+        discord_client.event(on_typing)
+    discord_client.event(on_raw_message_delete)
+    return discord_client
+
+
+def check_startup():
+    """
+    Import each module in a fresh interpreter and report its import time and resident memory.
+    """
+    probe = (
+        'import importlib, json, resource, sys, time\n'
+        'def rss_kb():\n'
+        '    try:\n'
+        '        with open("/proc/self/status") as status:\n'
+        '            for line in status:\n'
+        '                if line.startswith("VmRSS:"):\n'
+        '                    return int(line.split()[1])\n'
+        '    except OSError:\n'
+        '        pass\n'
+        '    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+        'before = rss_kb()\n'
+        'start = time.perf_counter()\n'
+        'importlib.import_module(sys.argv[1])\n'
+        'elapsed = time.perf_counter() - start\n'
+        'print(json.dumps({"import_ms": round(elapsed * 1000, 1), "rss_kb": rss_kb(), "rss_delta_kb": rss_kb() - before}))\n'
+    )
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    print(f'{"module":<20} {"import_ms":>10} {"rss_kb":>10} {"rss_delta_kb":>13}', flush=True)
+    for module in startup_modules:
+        result = subprocess.run(
+            [sys.executable, '-c', probe, module], cwd=module_dir, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            print(f'{module:<20} import failed: {result.stderr.strip().splitlines()[-1:]}', flush=True)
+            continue
+        stats = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f'{module:<20} {stats["import_ms"]:>10} {stats["rss_kb"]:>10} {stats["rss_delta_kb"]:>13}', flush=True)
+
+
+def run_shard_processes():
+    """
+    Split the shards across PROCESS_COUNT child processes and wait for them.
+    Each child re-runs this module with its own SHARD_IDS.
+    """
+    processes = []
+    for index in range(process_count):
+        child_shards = list(range(index, shard_count, process_count))
+        if not child_shards:
+            continue
+        child_env = dict(os.environ, SHARD_IDS=','.join(str(shard_id) for shard_id in child_shards))
+        print(f'Starting shard process {index} with shards {child_shards}', flush=True)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=child_env))
+
+    def stop_children(signum, frame):
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_children)
+    signal.signal(signal.SIGINT, stop_children)
+    exit_codes = [process.wait() for process in processes]
+    sys.exit(max(exit_codes, default=0))
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PAL Discord bot')
+    parser.add_argument('--check-startup', action='store_true', help='report import time and resident memory per module')
+    args = parser.parse_args()
+    if args.check_startup:
+        check_startup()
+        sys.exit(0)
+
+    if shard_count > 0 and process_count > 1 and not shard_ids:
+        run_shard_processes()
+
+    build_discord_client()
+
     async def main():
+        paltrace.start_loop_monitor()
         # Run the Discord client
         await discord_client.start(discord_token)
 
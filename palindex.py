@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+"""
+Local full-text index of channel messages for PAL.
+
+Messages from on_message are stored in SQLite with an FTS5 index, so handle_message can
+include the earlier messages most relevant to a question (BM25 ranked) alongside the recent
+tail. Edited and deleted messages are updated in or removed from the index. Each channel keeps at
+most INDEX_RETENTION messages. Set INDEX_PATH to an empty string to disable the index.
+"""
+import math
+import os
+import re
+import sqlite3
+import time
+
+index_path = os.getenv('INDEX_PATH', '/tmp/palindex.sqlite3')
+index_retention = int(os.getenv('INDEX_RETENTION', '200000'))
+prune_interval = 1000
+
+# Words too common to help ranking; dropping them keeps MATCH queries selective and fast
+stopwords = {
+    'a', 'about', 'all', 'also', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'can', 'could',
+    'decide', 'decided', 'did', 'do', 'does', 'for', 'from', 'get', 'got', 'had', 'has', 'have', 'hey', 'how', 'i',
+    'in', 'into', 'is', 'it', 'just', 'know', 'like', 'me', 'more', 'my', 'not', 'of', 'on', 'or', 'our', 'out',
+    'pal', 'said', 'say', 'says', 'should', 'so', 'some', 'tell', 'than', 'that', 'the', 'them', 'then', 'there',
+    'they', 'think', 'this', 'to', 'told', 'us', 'was', 'we', 'were', 'what', 'when', 'where', 'which', 'who', 'why',
+    'will', 'with', 'would', 'you', 'your',
+}
+max_query_terms = 8
+word_pattern = re.compile(r'\w+')
+# Newest matching messages taken per query term for ranking, and the BM25 parameters.
+# A window per term keeps a common term from crowding out the messages that match a rare one.
+candidate_window = 200
+bm25_k1 = 1.2
+bm25_b = 0.75
+
+_connection = None
+_inserts_since_prune = {}
+
+
+def get_connection():
+    """
+    Open the index database on first use and create the tables if needed.
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(index_path, timeout=5, isolation_level=None, check_same_thread=False)
+        _connection.execute('PRAGMA journal_mode=WAL')
+        _connection.execute('PRAGMA synchronous=NORMAL')
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS message_log (
+                id INTEGER PRIMARY KEY,
+                channel_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                author TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS message_log_channel ON message_log (channel_id, id);
+            CREATE INDEX IF NOT EXISTS message_log_message ON message_log (message_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+                content, channel, content='message_log', content_rowid='id', tokenize='unicode61'
+            );
+            CREATE TRIGGER IF NOT EXISTS message_log_insert AFTER INSERT ON message_log BEGIN
+                INSERT INTO message_fts (rowid, content, channel) VALUES (new.id, new.content, 'c' || new.channel_id);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_log_delete AFTER DELETE ON message_log BEGIN
+                INSERT INTO message_fts (message_fts, rowid, content, channel)
+                VALUES ('delete', old.id, old.content, 'c' || old.channel_id);
+            END;
+            CREATE TRIGGER IF NOT EXISTS message_log_update AFTER UPDATE ON message_log BEGIN
+                INSERT INTO message_fts (message_fts, rowid, content, channel)
+                VALUES ('delete', old.id, old.content, 'c' || old.channel_id);
+                INSERT INTO message_fts (rowid, content, channel) VALUES (new.id, new.content, 'c' || new.channel_id);
+            END;
+        """)
+    return _connection
+
+
+def add_message(channel_id, message_id, author, content):
+    """
+    Index a message, pruning the channel back to INDEX_RETENTION every prune_interval inserts.
+    """
+    if not index_path or not content.strip():
+        return
+    try:
+        connection = get_connection()
+        connection.execute(
+            'INSERT INTO message_log (channel_id, message_id, author, content, created) VALUES (?, ?, ?, ?, ?)',
+            (channel_id, message_id, author, content, time.time()),
+        )
+        _inserts_since_prune[channel_id] = _inserts_since_prune.get(channel_id, 0) + 1
+        if _inserts_since_prune[channel_id] >= prune_interval:
+            _inserts_since_prune[channel_id] = 0
+            prune_channel(channel_id)
+    except sqlite3.Error as err:
+        print(f'Index write error (channel {channel_id}): {err}', flush=True)
+
+
+def update_message(channel_id, message_id, content):
+    """
+    Replace the indexed content of an edited message. A message edited down to nothing is removed.
+    """
+    if not index_path:
+        return
+    if not content.strip():
+        delete_message(channel_id, message_id)
+        return
+    try:
+        get_connection().execute(
+            'UPDATE message_log SET content = ? WHERE channel_id = ? AND message_id = ?', (content, channel_id, message_id),
+        )
+    except sqlite3.Error as err:
+        print(f'Index update error (channel {channel_id}): {err}', flush=True)
+
+
+def delete_message(channel_id, message_id):
+    """
+    Remove a deleted message from the index.
+    """
+    if not index_path:
+        return
+    try:
+        get_connection().execute(
+            'DELETE FROM message_log WHERE channel_id = ? AND message_id = ?', (channel_id, message_id),
+        )
+    except sqlite3.Error as err:
+        print(f'Index delete error (channel {channel_id}): {err}', flush=True)
+
+
+def prune_channel(channel_id):
+    """
+    Delete the oldest messages beyond INDEX_RETENTION for one channel.
+    """
+    connection = get_connection()
+    row = connection.execute(
+        'SELECT id FROM message_log WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?',
+        (channel_id, index_retention),
+    ).fetchone()
+    if row:
+        connection.execute('DELETE FROM message_log WHERE channel_id = ? AND id <= ?', (channel_id, row[0]))
+
+
+def query_terms(text):
+    """
+    Return the distinctive lowercase terms of text, in order, without duplicates.
+    """
+    terms = []
+    for term in word_pattern.findall(text.lower()):
+        if len(term) > 2 and term not in stopwords and term not in terms:
+            terms.append(term)
+    return terms[:max_query_terms]
+
+
+def rank_bm25(terms, candidates, limit):
+    """
+    Rank (author, content) candidates against terms with Okapi BM25, using the candidate set for document statistics.
+    Repeated content is only returned once.
+    """
+    documents = [word_pattern.findall(content.lower()) for author, content in candidates]
+    if not documents:
+        return []
+    average_length = sum(len(words) for words in documents) / len(documents) or 1
+    document_frequency = {term: sum(1 for words in documents if term in words) for term in terms}
+    scores = []
+    for index, words in enumerate(documents):
+        score = 0.0
+        for term in terms:
+            frequency = words.count(term)
+            if not frequency:
+                continue
+            idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            score += idf * frequency * (bm25_k1 + 1) / (
+                frequency + bm25_k1 * (1 - bm25_b + bm25_b * len(words) / average_length)
+            )
+        scores.append((score, index))
+    scores.sort(key=lambda item: (-item[0], -item[1]))
+    results = []
+    seen = set()
+    for score, index in scores:
+        content = ' '.join(documents[index])
+        if score <= 0 or content in seen:
+            continue
+        seen.add(content)
+        results.append(candidates[index])
+        if len(results) == limit:
+            break
+    return results
+
+
+def search(channel_id, text, limit=5, exclude_ids=()):
+    """
+    Return up to limit (author, content) pairs from the channel ranked by BM25 relevance to text.
+    Messages whose IDs are in exclude_ids are skipped because they are already sent as the recent tail.
+
+    FTS5 picks the newest candidate_window matches of each term in rowid order, which stays fast
+    however large the channel is, and BM25 ranks their union. Scoring every match with bm25() would
+    have to read the full posting list of common terms.
+    """
+    terms = query_terms(text)
+    if not index_path or not terms:
+        return []
+    exclude_ids = list(exclude_ids)
+    term_query = 'SELECT * FROM (SELECT rowid FROM message_fts WHERE message_fts MATCH ? ORDER BY rowid DESC LIMIT ?)'
+    parameters = []
+    for term in terms:
+        parameters += [f'channel:"c{channel_id}" AND "{term}"', candidate_window + len(exclude_ids)]
+    try:
+        candidates = get_connection().execute(
+            f'SELECT author, content FROM message_log WHERE id IN ({" UNION ".join([term_query] * len(terms))}) '
+            f'AND message_id NOT IN ({", ".join("?" * len(exclude_ids))}) '
+            'ORDER BY id DESC',
+            (*parameters, *exclude_ids),
+        ).fetchall()
+    except sqlite3.Error as err:
+        print(f'Index search error (channel {channel_id}): {err}', flush=True)
+        return []
+    return rank_bm25(terms, candidates, limit)
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""
+Batch judgement CLI.
+
+Streams statements from a JSONL file through provide_judgement and appends the results
+to an output JSONL file. The output file doubles as the checkpoint: statements whose id
+is already in it are skipped when the command is re-run, except those marked failed, which
+are retried.
+
+  python paljudge.py input.jsonl output.jsonl --concurrency 4
+
+With --compare-batching each statement's judge panel is run both per-judge and batched
+(see JUDGE_BATCHING in paldiscord) instead, and the output records how closely the two
+modes agree, along with their latency and provider round-trips.
+
+Each input line is an object with a "statement" (or "message") and an optional "id";
+the line number is used when no id is given.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import paldiscord
+
+
+def load_checkpoint(output_path):
+    """
+    Return the ids already judged in the output file. Failed rows are left out so they are retried.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+                if not record.get('failed'):
+                    done.add(str(record['id']))
+            except (ValueError, KeyError, AttributeError):
+                continue
+    return done
+
+
+def read_statements(input_path, done):
+    """
+    Yield (id, statement) pairs from the input file, skipping ids already judged.
+    """
+    with open(input_path) as input_file:
+        for line_number, line in enumerate(input_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as err:
+                print(f'Skipping invalid JSON on line {line_number}: {err}', flush=True)
+                continue
+            record_id = str(record.get('id', line_number))
+            statement = record.get('statement') or record.get('message') or ''
+            if record_id in done or not statement:
+                continue
+            yield record_id, statement
+
+
+async def judge_statement(record_id, statement, output_file, totals):
+    cached = await paldiscord.check_judgement_cache(statement) is not None
+    start_time = time.perf_counter()
+    judgement = await paldiscord.provide_judgement({'message': statement})
+    elapsed = time.perf_counter() - start_time
+    failed = judgement in paldiscord.judgement_errors
+    output_file.write(json.dumps({
+        'id': record_id,
+        'statement': statement,
+        'judgement': judgement,
+        'cached': cached,
+        'failed': failed,
+        'elapsed': round(elapsed, 3),
+    }) + '\n')
+    output_file.flush()
+    totals['judged'] += 1
+    totals['cached'] += int(cached)
+    totals['failed'] += int(failed)
+
+
+async def compare_statement(record_id, statement, output_file, totals):
+    judges = paldiscord.select_expert_judges(statement)
+    modes = {}
+    for mode, batched in (('per_judge', False), ('batched', True)):
+        # Count the requests actually sent, including judges re-asked individually after a batch
+        call_counter = {'calls': 0}
+        token = paldiscord.provider_call_counter.set(call_counter)
+        start_time = time.perf_counter()
+        try:
+            judgements = await paldiscord.get_judge_responses(judges, statement, batched=batched)
+        finally:
+            paldiscord.provider_call_counter.reset(token)
+        modes[mode] = {
+            'elapsed': round(time.perf_counter() - start_time, 3),
+            'calls': call_counter['calls'],
+            'judgements': judgements,
+        }
+
+    # Compare each judge's verdict and confidence across the two modes
+    agreements = []
+    confidence_deltas = []
+    for single, batched in zip(modes['per_judge']['judgements'], modes['batched']['judgements']):
+        agreements.append(
+            paldiscord.judgement_sentiment(single['content']) == paldiscord.judgement_sentiment(batched['content'])
+        )
+        confidence_deltas.append(abs(single['confidence'] - batched['confidence']))
+    agreement = sum(agreements) / len(agreements)
+    confidence_delta = sum(confidence_deltas) / len(confidence_deltas)
+
+    output_file.write(json.dumps({
+        'id': record_id,
+        'statement': statement,
+        'agreement': round(agreement, 3),
+        'confidence_delta': round(confidence_delta, 3),
+        **modes,
+    }) + '\n')
+    output_file.flush()
+    totals['judged'] += 1
+    totals['agreement'] += agreement
+    totals['confidence_delta'] += confidence_delta
+    for mode, stats in modes.items():
+        totals[f'{mode}_elapsed'] += stats['elapsed']
+        totals[f'{mode}_calls'] += stats['calls']
+
+
+def report_comparison(totals):
+    judged = totals['judged']
+    if not judged:
+        return
+    print(f'\nBatched vs per-judge over {judged} statements:', flush=True)
+    print(f'  verdict agreement:      {totals["agreement"] / judged:.1%}', flush=True)
+    print(f'  mean confidence delta:  {totals["confidence_delta"] / judged:.2f}', flush=True)
+    for mode in ('per_judge', 'batched'):
+        print(f'  {mode:<10} avg latency {totals[f"{mode}_elapsed"] / judged:.2f}s, '
+              f'{totals[f"{mode}_calls"]} provider calls', flush=True)
+
+
+async def run_batch(input_path, output_path, concurrency, compare_batching=False):
+    done = load_checkpoint(output_path)
+    if done:
+        print(f'Resuming, {len(done)} statements already judged', flush=True)
+
+    totals = {
+        'judged': 0, 'cached': 0, 'failed': 0, 'agreement': 0.0, 'confidence_delta': 0.0,
+        'per_judge_elapsed': 0.0, 'per_judge_calls': 0, 'batched_elapsed': 0.0, 'batched_calls': 0,
+    }
+    worker = compare_statement if compare_batching else judge_statement
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    start_time = time.perf_counter()
+
+    def release(task):
+        tasks.discard(task)
+        semaphore.release()
+        if not task.cancelled() and task.exception():
+            print(f'Error judging statement: {task.exception()}', flush=True)
+
+    with open(output_path, 'a') as output_file:
+        # Acquire before reading the next line so at most `concurrency` statements are held in memory
+        for record_id, statement in read_statements(input_path, done):
+            await semaphore.acquire()
+            task = asyncio.create_task(worker(record_id, statement, output_file, totals))
+            tasks.add(task)
+            task.add_done_callback(release)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    elapsed = time.perf_counter() - start_time
+    throughput = totals['judged'] / elapsed if elapsed else 0
+    print(f'\nJudged {totals["judged"]} statements ({totals["cached"]} cached, {totals["failed"]} failed) in {elapsed:.1f}s '
+          f'({throughput:.2f} statements/s)', flush=True)
+    print(f'{"judge":<24} {"calls":>6} {"avg_s":>8} {"max_s":>8}', flush=True)
+    for name, stats in sorted(paldiscord.judge_stats.items()):
+        print(f'{name:<24} {stats["count"]:>6} {stats["total"] / stats["count"]:>8.2f} {stats["max"]:>8.2f}', flush=True)
+    if compare_batching:
+        report_comparison(totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the PAL judgement pipeline over a JSONL file')
+    parser.add_argument('input', help='JSONL file of statements')
+    parser.add_argument('output', help='JSONL file to append judgements to (also used as the checkpoint)')
+    parser.add_argument('--concurrency', type=int, default=4, help='maximum statements judged at once')
+    parser.add_argument('--compare-batching', action='store_true',
+                        help='run each judge panel per-judge and batched and report how closely they agree')
+    args = parser.parse_args()
+
+    asyncio.run(run_batch(args.input, args.output, max(1, args.concurrency), args.compare_batching))
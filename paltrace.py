@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+"""
+Lightweight span tracing and event-loop lag monitoring for PAL.
+
+Spans are written to TRACE_PATH as they finish, one JSON object per line. TRACE_FORMAT=jsonl
+writes flat span records; TRACE_FORMAT=otlp writes each span as an OTLP/JSON
+ExportTraceServiceRequest so the file can be loaded by OpenTelemetry tooling without a collector.
+Tracing is disabled when TRACE_PATH is empty.
+
+The loop monitor runs a heartbeat coroutine and a watchdog thread. When the heartbeat is late
+by more than LOOP_LAG_THRESHOLD_MS the watchdog captures the stack of the event loop thread,
+which shows the code that is blocking it.
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+trace_path = os.getenv('TRACE_PATH', '')
+trace_format = os.getenv('TRACE_FORMAT', 'jsonl')
+loop_lag_threshold = float(os.getenv('LOOP_LAG_THRESHOLD_MS', '250')) / 1000
+
+current_span = contextvars.ContextVar('current_span', default=None)
+export_lock = threading.Lock()
+loop_monitor_task = None
+
+
+def new_id(size):
+    return os.urandom(size).hex()
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """
+    Record a span around the block. Spans started inside the block, including in tasks
+    created from it, become its children.
+    """
+    if not trace_path:
+        yield None
+        return
+
+    parent = current_span.get()
+    record = {
+        'trace_id': parent['trace_id'] if parent else new_id(16),
+        'span_id': new_id(8),
+        'parent_id': parent['span_id'] if parent else '',
+        'name': name,
+        'start_ns': time.time_ns(),
+        'end_ns': 0,
+        'status': 'ok',
+        'attributes': attributes,
+    }
+    token = current_span.set(record)
+    try:
+        yield record
+    except asyncio.CancelledError:
+        record['status'] = 'cancelled'
+        raise
+    except Exception as err:
+        record['status'] = 'error'
+        record['attributes']['error'] = repr(err)
+        raise
+    finally:
+        record['end_ns'] = time.time_ns()
+        current_span.reset(token)
+        export(record)
+
+
+def set_attribute(key, value):
+    """
+    Add an attribute to the current span, if tracing is enabled.
+    """
+    record = current_span.get()
+    if record is not None:
+        record['attributes'][key] = value
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def format_otlp(record):
+    status_codes = {'ok': 1, 'error': 2, 'cancelled': 2}
+    otlp_span = {
+        'traceId': record['trace_id'],
+        'spanId': record['span_id'],
+        'name': record['name'],
+        'kind': 1,
+        'startTimeUnixNano': str(record['start_ns']),
+        'endTimeUnixNano': str(record['end_ns']),
+        'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in record['attributes'].items()],
+        'status': {'code': status_codes.get(record['status'], 0)},
+    }
+    if record['parent_id']:
+        otlp_span['parentSpanId'] = record['parent_id']
+    return {
+        'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'paldiscord'}}]},
+            'scopeSpans': [{'scope': {'name': 'paltrace'}, 'spans': [otlp_span]}],
+        }],
+    }
+
+
+def export(record):
+    if not trace_path:
+        return
+    if trace_format == 'otlp':
+        line = json.dumps(format_otlp(record))
+    else:
+        line = json.dumps(dict(record, duration_ms=round((record['end_ns'] - record['start_ns']) / 1e6, 3)))
+    try:
+        with export_lock, open(trace_path, 'a') as trace_file:
+            trace_file.write(line + '\n')
+    except OSError as err:
+        print(f'Unable to write trace to {trace_path}: {err}', flush=True)
+
+
+def start_loop_monitor():
+    """
+    Start the heartbeat coroutine and watchdog thread for the running event loop.
+    Does nothing if LOOP_LAG_THRESHOLD_MS is 0 or the monitor is already running.
+    """
+    global loop_monitor_task
+    if loop_lag_threshold <= 0 or loop_monitor_task is not None:
+        return
+
+    interval = loop_lag_threshold / 4
+    loop_thread_id = threading.get_ident()
+    state = {'heartbeat': time.monotonic()}
+
+    async def heartbeat():
+        while True:
+            state['heartbeat'] = time.monotonic()
+            await asyncio.sleep(interval)
+
+    def watchdog():
+        stall = None
+        while True:
+            time.sleep(interval)
+            last_beat = state['heartbeat']
+            lag = time.monotonic() - last_beat - interval
+            if stall is None and lag > loop_lag_threshold:
+                # Capture the loop thread's stack while it is still blocked
+                frame = sys._current_frames().get(loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame else ''
+                stall = {'heartbeat': last_beat, 'start_ns': time.time_ns() - int(lag * 1e9), 'stack': stack}
+            elif stall is not None and last_beat != stall['heartbeat']:
+                duration = last_beat - stall['heartbeat'] - interval
+                print(f'Event loop stalled for {duration * 1000:.0f}ms in:\n{stall["stack"]}', flush=True)
+                export({
+                    'trace_id': new_id(16),
+                    'span_id': new_id(8),
+                    'parent_id': '',
+                    'name': 'event_loop.stall',
+                    'start_ns': stall['start_ns'],
+                    'end_ns': stall['start_ns'] + int(duration * 1e9),
+                    'status': 'error',
+                    'attributes': {'stall_ms': round(duration * 1000, 1), 'stack': stall['stack']},
+                })
+                stall = None
+
+    loop_monitor_task = asyncio.get_running_loop().create_task(heartbeat())
+    threading.Thread(target=watchdog, name='loop-lag-watchdog', daemon=True).start()